@@ -4,16 +4,47 @@ _LIBDIR = os.environ["CIMEROOT"]
 sys.path.append(_LIBDIR)
 
 import argparse
+import concurrent.futures
+import functools
+import glob
+import hashlib
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
+import numpy as np
 import optuna
+import queue
 import re
-import random
+import shutil
+import signal
+import threading
+import time
+import xml.etree.ElementTree as ET
 from CIME.case import Case
 import CIME.build as build
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it the packing kernels simply run as Python
+    def njit(*args, **kwargs):
+        return lambda f: f
 
 TOTAL_PES = 1024
 COMPONENTS = ["ATM", "LND", "ICE", "CPL", "ROF", "GLC", "WAV", "OCN"]
 TASK_MAX_LIMITS = {"ATM": 5400}
 TASK_MIN_LIMITS = {"ATM": 64, "OCN": 512}
+POLL_INTERVAL = 30
+OCN_INDEX = COMPONENTS.index("OCN")
+
+_TIMING_RE = re.compile(rb"(?:Model Cost:\s+(?P<cost>[\d.]+))"
+                        rb"|(?:Model Throughput:\s+(?P<tput>[\d.]+))"
+                        rb"|(?:TOT Run Time:\s+(?P<tot>[\d.]+) seconds)"
+                        rb"|(?:^\s+(?!TOT )(?P<comp>[A-Z]{3}) Run Time:\s+(?P<ctime>[\d.]+) seconds)")
+_PROGRESS_RE = re.compile(rb"model date =.*avg dt =\s+([\d.]+)")
+_NEWEST_CACHE = {}
+
+log = logging.getLogger("cesm_lb")
 
 def parse_args():
     '''
@@ -31,55 +62,443 @@ def parse_args():
     parser.add_argument("--metric", choices=["throughput", "cost"], default="cost")
     parser.add_argument("--stop-option", default="ndays")
     parser.add_argument("--stop-n", type=int, default=5)
-    return parser.parse_args()
+    parser.add_argument("--study-name", default="cesm_lb")
+    parser.add_argument("--storage", default="sqlite:///cesm_lb.db")
+    parser.add_argument("--caseroot-template", default=None,
+                        help="Case to clone once per worker; each worker then runs in its own caseroot")
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--worker-id", type=int, default=None,
+                        help="Run only this worker, e.g. when workers are launched on separate nodes")
+    parser.add_argument("--jobs-per-worker", type=int, default=1,
+                        help="Concurrent trials per worker, each in its own clone, so one trial builds while another runs")
+    parser.add_argument("--sampler", choices=["cmaes", "tpe"], default="cmaes")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed the sampler so a study can be reproduced")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING"], default="INFO")
+    parser.add_argument("--bind-ranks", action="store_true",
+                        help="Pin MPI ranks NUMA-node by NUMA-node with an Open MPI rankfile")
+    args = parser.parse_args()
+    if args.num_workers > 1 and args.worker_id is None and not args.caseroot_template:
+        parser.error("--num-workers > 1 requires --caseroot-template")
+    if args.worker_id is not None and not args.caseroot_template:
+        parser.error("--worker-id requires --caseroot-template so each worker gets its own caseroot")
+    if args.jobs_per_worker > 1 and not args.caseroot_template:
+        parser.error("--jobs-per-worker > 1 requires --caseroot-template")
+    return args
 
-def snap_to_nearest(value, max_mpitasks_per_node):
-    candidates = [i for i in range(1, TOTAL_PES + 1) if max_mpitasks_per_node % i == 0 or i % max_mpitasks_per_node == 0]
-    return min(candidates, key=lambda x: abs(x - value))
+@functools.lru_cache(maxsize=None)
+def legal_ntasks(max_mpitasks_per_node):
+    '''
+    Sorted task counts up to TOTAL_PES that divide or are a multiple of max_mpitasks_per_node.
 
-def assign_rootpes(task_counts, overlap_map):
-    rootpes = {}
-    ocn_end = task_counts["OCN"]
-    rootpes["OCN"] = 0
+    >>> legal_ntasks(6).tolist()[:8]
+    [1, 2, 3, 6, 12, 18, 24, 30]
+    '''
+    divisors = set()
+    i = 1
+    while i * i <= max_mpitasks_per_node:
+        if max_mpitasks_per_node % i == 0:
+            divisors.update((i, max_mpitasks_per_node // i))
+        i += 1
+    multiples = range(max_mpitasks_per_node, TOTAL_PES + 1, max_mpitasks_per_node)
+    return np.array(sorted(c for c in divisors.union(multiples) if c <= TOTAL_PES))
 
-    assigned = set(["OCN"])
-    remaining = [c for c in COMPONENTS if c != "OCN"]
+def snap_to_nearest(values, max_mpitasks_per_node):
+    '''
+    Snap each value to its nearest legal task count; ties go to the smaller count.
 
-    random.shuffle(remaining)
-    while remaining:
-        a = remaining.pop(0)
-        if a in assigned:
-            continue
-        overlap_group = [a] + [b for b in remaining if overlap_map[a][b]]
-        overlap_group.sort(key=lambda c: task_counts[c], reverse=True)
-
-        base = ocn_end
-        for i, comp in enumerate(overlap_group):
-            ntasks = task_counts[comp]
-            rootpes[comp] = base
-            if i + 1 < len(overlap_group):
-                next_comp = overlap_group[i + 1]
-                next_ntasks = task_counts[next_comp]
-                if next_ntasks < ntasks:
-                    base += next_ntasks
-                else:
-                    base += ntasks
-            assigned.add(comp)
-            if comp in remaining:
-                remaining.remove(comp)
+    >>> snap_to_nearest([100, 200, 96], 128).tolist()
+    [128, 256, 64]
+    >>> snap_to_nearest([5, 1000], 6).tolist()
+    [6, 1002]
+    '''
+    legal = legal_ntasks(max_mpitasks_per_node)
+    return legal[np.abs(legal[None, :] - np.asarray(values)[:, None]).argmin(axis=1)]
+
+def stick_breaking(splits):
+    '''
+    Map n-1 values in [0, 1] to n shares summing to 1. Split i goes through the
+    inverse Beta(1, n-1-i) CDF first, so a uniform unit cube maps uniformly onto
+    the simplex instead of piling up on the first shares.
+
+    >>> stick_breaking([0.75, 0.5]).tolist()
+    [0.5, 0.25, 0.25]
+    >>> stick_breaking([]).tolist()
+    [1.0]
+    '''
+    splits = np.asarray(splits, dtype=float)
+    splits = 1.0 - (1.0 - splits) ** (1.0 / np.arange(len(splits), 0, -1))
+    remaining = np.concatenate(([1.0], np.cumprod(1.0 - splits)))
+    return np.append(splits, 1.0) * remaining
+
+@functools.lru_cache(maxsize=None)
+def overlap_candidates(stub_comps):
+    '''
+    Unordered component pairs that may share PEs; overlap is symmetric so each pair is sampled once.
 
+    >>> overlap_candidates(frozenset({"GLC", "WAV", "ROF"}))
+    (('ATM', 'LND'), ('ATM', 'ICE'), ('ATM', 'CPL'), ('LND', 'ICE'), ('LND', 'CPL'), ('ICE', 'CPL'))
+    '''
+    return tuple(itertools.combinations([c for c in COMPONENTS if c != "OCN" and c not in stub_comps], 2))
+
+@njit(cache=True)
+def _find(parent, c):
+    while parent[c] != c:
+        parent[c] = parent[parent[c]]
+        c = parent[c]
+    return c
+
+# Compiled eagerly for this signature (and cached on disk) so no trial pays the JIT cost
+@njit("int32[:](int32[:], int8[:, :])", cache=True)
+def _pack(ntasks, overlap_mat):
+    # Indices follow COMPONENTS; ntasks == 0 marks a stub. Stubs and OCN keep rootpe 0.
+    n = ntasks.shape[0]
+    parent = np.arange(n).astype(np.int32)
+    for a in range(n):
+        for b in range(a + 1, n):
+            if (overlap_mat[a, b] or overlap_mat[b, a]) and a != OCN_INDEX and b != OCN_INDEX \
+                    and ntasks[a] > 0 and ntasks[b] > 0:
+                parent[_find(parent, b)] = _find(parent, a)
+    group_max = np.zeros(n, np.int32)
+    group_first = np.full(n, n, np.int32)
+    for c in range(n):
+        if c != OCN_INDEX and ntasks[c] > 0:
+            r = _find(parent, c)
+            group_max[r] = max(group_max[r], ntasks[c])
+            group_first[r] = min(group_first[r], c)
+
+    # Place groups largest first, ties in COMPONENTS order of their first member
+    group_rootpe = np.zeros(n, np.int32)
+    base = ntasks[OCN_INDEX]
+    while True:
+        best = -1
+        for r in range(n):
+            if group_max[r] > 0 and (best < 0 or group_max[r] > group_max[best]
+                                     or (group_max[r] == group_max[best] and group_first[r] < group_first[best])):
+                best = r
+        if best < 0:
+            break
+        group_rootpe[best] = base
+        base += group_max[best]
+        group_max[best] = 0
+
+    rootpes = np.zeros(n, np.int32)
+    for c in range(n):
+        if c != OCN_INDEX and ntasks[c] > 0:
+            rootpes[c] = group_rootpe[_find(parent, c)]
     return rootpes
 
-def configure_case(case: Case, config, stop_option, stop_n):
-    for comp, vals in config.items():
-        case.set_value(f"NTASKS_{comp}", vals["ntasks"])
-        case.set_value(f"NTHRDS_{comp}", vals["nthrds"])
-        case.set_value(f"ROOTPE_{comp}", vals["rootpe"])
-    case.set_value("STOP_OPTION", stop_option)
-    case.set_value("STOP_N", stop_n)
-    case.case_setup(reset=True)
+def assign_rootpes(task_counts, overlap_map, stub_comps=frozenset()):
+    '''
+    OCN starts at rootpe 0; components joined by overlap_map share a rootpe and
+    the resulting groups are packed after OCN, largest first. Raises ValueError
+    if the packed layout does not fit in TOTAL_PES.
+
+    >>> counts = {"ATM": 256, "LND": 64, "ICE": 128, "CPL": 128, "ROF": 32, "GLC": 1, "WAV": 1, "OCN": 512}
+    >>> overlap_map = {a: {b: False for b in COMPONENTS} for a in COMPONENTS}
+    >>> overlap_map["ATM"]["LND"] = overlap_map["ICE"]["ROF"] = overlap_map["LND"]["CPL"] = True
+    >>> rootpes = assign_rootpes(counts, overlap_map, stub_comps=frozenset({"GLC", "WAV"}))
+    >>> [rootpes[c] for c in COMPONENTS]
+    [512, 512, 768, 512, 768, 0, 0, 0]
+    >>> assign_rootpes(counts, {a: {b: False for b in COMPONENTS} for a in COMPONENTS}, frozenset({"GLC", "WAV"}))
+    Traceback (most recent call last):
+    ...
+    ValueError: Layout needs 1120 PEs, more than TOTAL_PES=1024
+    '''
+    ntasks = np.array([0 if c in stub_comps else task_counts[c] for c in COMPONENTS], dtype=np.int32)
+    overlap_mat = np.array([[overlap_map[a][b] for b in COMPONENTS] for a in COMPONENTS], dtype=np.int8)
+    packed = _pack(ntasks, overlap_mat)
+    needed = int((packed + ntasks).max())
+    if needed > TOTAL_PES:
+        raise ValueError(f"Layout needs {needed} PEs, more than TOTAL_PES={TOTAL_PES}")
+    return dict(zip(COMPONENTS, packed.tolist()))
+
+def patch_env_xml(path, updates):
+    '''
+    Apply (id, compclass, value) updates to a CIME env_*.xml file in place and
+    return whether anything changed. compclass selects the per-component
+    <value> of entries such as NTASKS; None sets the entry's value attribute.
+
+    >>> import tempfile, os
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     path = os.path.join(tmpdir, 'env_mach_pes.xml')
+    ...     with open(path, 'w') as f:
+    ...         _ = f.write('<file id="env_mach_pes.xml"><group id="mach_pes">'
+    ...                     '<entry id="NTASKS"><values><value compclass="ATM">64</value></values></entry>'
+    ...                     '<entry id="STOP_N" value="5"/></group></file>')
+    ...     first = patch_env_xml(path, [("NTASKS", "ATM", 128), ("STOP_N", None, 5)])
+    ...     again = patch_env_xml(path, [("NTASKS", "ATM", 128)])
+    ...     text = open(path).read()
+    >>> first, again, '<value compclass="ATM">128</value>' in text
+    (True, False, True)
+    '''
+    tree = ET.parse(path, parser=ET.XMLParser(target=ET.TreeBuilder(insert_comments=True)))
+    root = tree.getroot()
+    changed = False
+    for vid, compclass, value in updates:
+        entry = root.find(f".//entry[@id='{vid}']")
+        if compclass is None:
+            node, current = entry, entry.get("value")
+        else:
+            node = entry.find(f"values/value[@compclass='{compclass}']")
+            current = node.text
+        if current != str(value):
+            if compclass is None:
+                node.set("value", str(value))
+            else:
+                node.text = str(value)
+            changed = True
+    if changed:
+        tree.write(path, xml_declaration=True, encoding="UTF-8")
+    return changed
+
+def configure_case(caseroot, config, stop_option, stop_n, srcroot_mtime):
+    # Patch the env files directly instead of round-tripping every value through
+    # CIME, and only redo case.setup when the PE layout actually changed.
+    pes_changed = patch_env_xml(os.path.join(caseroot, "env_mach_pes.xml"),
+                                [(var, comp, vals[var.lower()]) for comp, vals in config.items()
+                                 for var in ("NTASKS", "NTHRDS", "ROOTPE")])
+    patch_env_xml(os.path.join(caseroot, "env_run.xml"), [("STOP_OPTION", None, stop_option), ("STOP_N", None, stop_n)])
+    with Case(caseroot, read_only=False) as case:
+        if pes_changed or not os.path.isfile(os.path.join(caseroot, "LockedFiles", "env_mach_pes.xml")):
+            case.case_setup(reset=True)
+        build_with_cache(case, srcroot_mtime)
+        return case.get_value("RUNDIR")
+
+def _newest_mtime(path):
+    newest = 0
+    for dirpath, _, files in os.walk(path):
+        for f in files:
+            newest = max(newest, os.lstat(os.path.join(dirpath, f)).st_mtime_ns)
+    return newest
+
+def _env_build_settings(caseroot):
+    '''
+    Entries of env_build.xml that feed the build, including the compile-time
+    decomposition case.setup derives from the PE layout (e.g. POP_BLCKX).
+
+    >>> import tempfile, os
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     with open(os.path.join(tmpdir, 'env_build.xml'), 'w') as f:
+    ...         _ = f.write('<file><group><entry id="POP_BLCKX" value="16"/><entry id="BUILD_COMPLETE" value="TRUE"/>'
+    ...                     '<entry id="BUILD_STATUS" value="0"/></group></file>')
+    ...     _env_build_settings(tmpdir)
+    [('POP_BLCKX', '16')]
+    '''
+    root = ET.parse(os.path.join(caseroot, "env_build.xml")).getroot()
+    return sorted((entry.get("id"), entry.get("value")) for entry in root.iter("entry")
+                  if entry.get("id") not in ("BUILD_COMPLETE", "BUILD_STATUS"))
+
+def build_cache_key(case, srcroot_mtime):
+    h = hashlib.sha256()
+    for var in ("COMPSET", "MACH", "COMPILER", "MPILIB", "DEBUG"):
+        h.update(f"{var}={case.get_value(var)};".encode())
+    h.update(f"SRCROOT={srcroot_mtime};".encode())
+    sourcemods = os.path.join(case.get_value("CASEROOT"), "SourceMods")
+    h.update(f"SourceMods={_newest_mtime(sourcemods)};".encode())
+    h.update(repr(_env_build_settings(case.get_value("CASEROOT"))).encode())
+    return h.hexdigest()
+
+def build_with_cache(case, srcroot_mtime):
+    '''
+    Reuse the bld tree from an earlier trial whenever the build inputs are unchanged.
+    Returning to an earlier key also restores the env_build.xml lock it was built
+    under, so check_lockedfiles does not mark the build incomplete at submit.
+
+    >>> import tempfile, unittest.mock
+    >>> class StubCase:
+    ...     def __init__(self, caseroot):
+    ...         self._caseroot = caseroot
+    ...     def get_value(self, var):
+    ...         return {"CASEROOT": self._caseroot, "EXEROOT": os.path.join(self._caseroot, "bld")}.get(var, var)
+    ...     def set_value(self, var, value):
+    ...         pass
+    ...     def flush(self):
+    ...         pass
+    >>> builds = []
+    >>> def stub_build(caseroot, case):
+    ...     os.makedirs(os.path.join(caseroot, "bld"))
+    ...     shutil.copy(os.path.join(caseroot, "env_build.xml"), os.path.join(caseroot, "LockedFiles"))
+    ...     builds.append(_env_build_settings(caseroot))
+    >>> def build_as(caseroot, blckx):
+    ...     with open(os.path.join(caseroot, "env_build.xml"), "w") as f:
+    ...         _ = f.write(f'<file><entry id="POP_BLCKX" value="{blckx}"/></file>')
+    ...     with unittest.mock.patch.object(build, "case_build", stub_build):
+    ...         build_with_cache(StubCase(caseroot), 0)
+    ...     with open(os.path.join(caseroot, "LockedFiles", "env_build.xml")) as f:
+    ...         return f'value="{blckx}"' in f.read()
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     os.mkdir(os.path.join(tmpdir, "LockedFiles"))
+    ...     build_as(tmpdir, 16), build_as(tmpdir, 32), build_as(tmpdir, 16)
+    (True, True, True)
+    >>> builds
+    [[('POP_BLCKX', '16')], [('POP_BLCKX', '32')]]
+    '''
+    # NTASKS/NTHRDS/ROOTPE edits do not change the executable unless case.setup
+    # changed a compile-time setting in env_build.xml, which is part of the key.
+    case.flush()
+    exeroot = case.get_value("EXEROOT")
+    locked = os.path.join(case.get_value("CASEROOT"), "LockedFiles", "env_build.xml")
+    # Beside EXEROOT so moving a fresh build into the cache is a rename, not a copy
+    cache_dir = os.path.join(os.path.dirname(exeroot), ".bld_cache", build_cache_key(case, srcroot_mtime))
+    cached_lock = os.path.join(cache_dir, "env_build.xml.locked")
+    if os.path.isfile(cached_lock):
+        if os.path.realpath(exeroot) != os.path.realpath(cache_dir):
+            if os.path.islink(exeroot):
+                os.unlink(exeroot)
+            elif os.path.isdir(exeroot):
+                shutil.rmtree(exeroot)
+            os.symlink(cache_dir, exeroot)
+        # A build for another key may have re-locked env_build.xml since
+        shutil.copyfile(cached_lock, locked)
+        case.set_value("BUILD_COMPLETE", True)
+        return
+    if os.path.islink(exeroot):
+        os.unlink(exeroot)
     build.case_build(case._caseroot, case=case)
-    case.submit(no_batch=True)
+    shutil.copyfile(locked, os.path.join(exeroot, "env_build.xml.locked"))
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    # Drop an entry left without its lock, e.g. by an interrupted move
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    shutil.move(exeroot, cache_dir)
+    os.symlink(cache_dir, exeroot)
+
+def _parse_cpulist(text):
+    '''
+    >>> _parse_cpulist("0-3,8,10-11\\n")
+    [0, 1, 2, 3, 8, 10, 11]
+    '''
+    cpus = []
+    for part in text.strip().split(","):
+        if part:
+            lo, _, hi = part.partition("-")
+            cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def numa_cores(sysfs="/sys/devices/system"):
+    # OS ids of the PUs of each NUMA node, first hardware thread of every core ahead of its SMT siblings
+    nodes = sorted(glob.glob(os.path.join(sysfs, "node", "node[0-9]*")), key=lambda p: int(p.rsplit("node", 1)[1]))
+    result = []
+    for node in nodes:
+        with open(os.path.join(node, "cpulist")) as f:
+            cpus = _parse_cpulist(f.read())
+        primary, siblings = [], []
+        for cpu in cpus:
+            with open(os.path.join(sysfs, "cpu", f"cpu{cpu}", "topology", "thread_siblings_list")) as f:
+                (primary if cpu == min(_parse_cpulist(f.read())) else siblings).append(cpu)
+        result.append(primary + siblings)
+    return result
+
+def rankfile_lines(nranks, max_mpitasks_per_node, numa):
+    '''
+    Give each NUMA node a contiguous block of local ranks so components, which
+    occupy contiguous rank ranges, stay within as few NUMA nodes as possible.
+    Slots are OS PU ids, so the rankfile must be read in Open MPI's physical mode.
+
+    >>> rankfile_lines(6, 4, [[0, 2, 4, 6], [1, 3, 5, 7]])
+    ['rank 0=+n0 slot=0', 'rank 1=+n0 slot=2', 'rank 2=+n0 slot=1', 'rank 3=+n0 slot=3', 'rank 4=+n1 slot=0', 'rank 5=+n1 slot=2']
+    '''
+    per_node = -(-max_mpitasks_per_node // len(numa))
+    slots = ([pu for pus in numa for pu in pus[:per_node]] +
+             [pu for pus in numa for pu in pus[per_node:]])[:max_mpitasks_per_node]
+    return [f"rank {r}=+n{r // max_mpitasks_per_node} slot={slots[r % max_mpitasks_per_node]}" for r in range(nranks)]
+
+def _submit(caseroot, rankfile=None):
+    # Run in a new session so cancel() can signal mpirun and its ranks as a group
+    os.setsid()
+    if rankfile:
+        os.environ["OMPI_MCA_rmaps_rank_file_path"] = rankfile
+        # Open MPI otherwise reads slots as logical core indexes, not the sysfs ids we write
+        os.environ["OMPI_MCA_rmaps_rank_file_physical"] = "1"
+    with Case(caseroot, read_only=False) as case:
+        case.submit(no_batch=True)
+
+def cancel(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    proc.join()
+
+def _newest_file(dirpath, prefixes):
+    # Rescan only when the directory itself changed, i.e. a file was added or removed
+    try:
+        mtime = os.stat(dirpath).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _NEWEST_CACHE.get((dirpath, prefixes))
+    if cached and cached[0] == mtime:
+        return cached[1]
+    files = [e for e in os.scandir(dirpath) if e.name.startswith(prefixes)]
+    newest = max(files, key=lambda e: e.stat().st_mtime).path if files else None
+    _NEWEST_CACHE[(dirpath, prefixes)] = (mtime, newest)
+    return newest
+
+def parse_progress(rundir, since=0, state=None):
+    '''
+    Per-day average wallclock seconds from the newest mediator/coupler log.
+    Pass the same state dict on each poll to only read bytes appended since the last one.
+
+    >>> import tempfile, os
+    >>> state = {}
+    >>> with tempfile.TemporaryDirectory() as tmpdir:
+    ...     with open(os.path.join(tmpdir, 'med.log.1234'), 'w') as f:
+    ...         _ = f.write(' tStamp_write: model date =   00010102       0 wall clock = 2024-01-01 00:01:00 avg dt =    60.00 dt =    60.00\\n')
+    ...         _ = f.write(' tStamp_write: model date =   00010103       0 wall clock = 2024-01-01 00:01:50 avg dt =    55.00 dt =    50.00\\n')
+    ...         _ = f.write(' tStamp_write: model date =   00010104')
+    ...         _ = f.flush()
+    ...         first = parse_progress(tmpdir, state=state)
+    ...         _ = f.write('       0 wall clock = 2024-01-01 00:02:40 avg dt =    53.33 dt =    50.00\\n')
+    ...     second = parse_progress(tmpdir, state=state)
+    >>> first, second
+    ([60.0, 55.0], [60.0, 55.0, 53.33])
+    '''
+    state = {} if state is None else state
+    path = _newest_file(rundir, ("med.log.", "cpl.log."))
+    if path is None or os.path.getmtime(path) < since:
+        return []
+    if state.get("path") != path:
+        state.update(path=path, offset=0, avg_dts=[])
+    with open(path, "rb") as f:
+        f.seek(state["offset"])
+        data = f.read()
+    # Leave a trailing partial line for the next poll
+    data = data[:data.rfind(b"\n") + 1]
+    state["offset"] += len(data)
+    state["avg_dts"] += [float(m.group(1)) for m in _PROGRESS_RE.finditer(data)]
+    return list(state["avg_dts"])
+
+def progress_metric(avg_dt, total_pes, metric):
+    '''
+    >>> progress_metric(60.0, 1024, "cost")
+    6229.333333333333
+    >>> round(progress_metric(60.0, 1024, "throughput"), 3)
+    3.945
+    '''
+    if metric == "throughput":
+        return 86400.0 / (avg_dt * 365)
+    return total_pes * avg_dt * 365 / 3600.0
+
+def run_case(trial, caseroot, rundir, total_pes, metric, rankfile=None):
+    start = time.time()
+    # Spawn rather than fork: a forked child inherits the build pool's exit hooks and fails on exit
+    proc = multiprocessing.get_context("spawn").Process(target=_submit, args=(caseroot, rankfile))
+    proc.start()
+    reported = 0
+    progress = {}
+    while proc.is_alive():
+        proc.join(POLL_INTERVAL)
+        avg_dts = parse_progress(rundir, since=start, state=progress)
+        if len(avg_dts) <= reported:
+            continue
+        for step in range(reported, len(avg_dts)):
+            trial.report(progress_metric(avg_dts[step], total_pes, metric), step + 1)
+        reported = len(avg_dts)
+        if trial.should_prune():
+            cancel(proc)
+            raise optuna.TrialPruned()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"Model run exited with status {proc.exitcode}")
 
 def parse_timing(case_dir):
     '''
@@ -103,77 +522,260 @@ def parse_timing(case_dir):
     True
     '''
     timing_dir = os.path.join(case_dir, "timing")
-    files = sorted(f for f in os.listdir(timing_dir) if f.startswith("cesm_timing"))
-    if not files:
+    last_file = _newest_file(timing_dir, "cesm_timing")
+    if last_file is None:
         raise RuntimeError("No timing files found.")
-    last_file = os.path.join(timing_dir, files[-1])
     result = {"total_cost": None, "throughput": None, "run_time": None, "component_times": {}}
-    with open(last_file) as f:
+    with open(last_file, "rb") as f:
         for line in f:
-            if m := re.search(r"Model Cost:\s+([\d.]+)", line):
-                result["total_cost"] = float(m.group(1))
-            elif m := re.search(r"Model Throughput:\s+([\d.]+)", line):
-                result["throughput"] = float(m.group(1))
-            elif m := re.search(r"TOT Run Time:\s+([\d.]+) seconds", line):
-                result["run_time"] = float(m.group(1))
-            elif m := re.search(r"^\s+([A-Z]{3}) Run Time:\s+([\d.]+) seconds", line):
-                result["component_times"][m.group(1)] = float(m.group(2))
+            m = _TIMING_RE.search(line)
+            if not m:
+                continue
+            g = m.lastgroup
+            if g == "cost":
+                result["total_cost"] = float(m.group("cost"))
+            elif g == "tput":
+                result["throughput"] = float(m.group("tput"))
+            elif g == "tot":
+                result["run_time"] = float(m.group("tot"))
+            else:
+                result["component_times"][m.group("comp").decode()] = float(m.group("ctime"))
     if not all([result["total_cost"], result["throughput"], result["run_time"]]):
         raise RuntimeError("Incomplete timing file")
     return result
 
-def objective(trial, caseroot, stop_option, stop_n, metric):
-    with Case(caseroot, read_only=False) as case:
-        max_mpitasks_per_node = case.get_value("MAX_MPITASKS_PER_NODE")
+def layout_key(config, metric, stop_option, stop_n, case_id):
+    '''
+    Study user-attr key identifying a PE layout evaluated for one case and
+    objective, stable across workers and storage backends.
+
+    >>> a = {"ATM": {"ntasks": 64, "nthrds": 1, "rootpe": 512}, "OCN": {"ntasks": 512, "nthrds": 1, "rootpe": 0}}
+    >>> b = {"OCN": {"rootpe": 0, "nthrds": 1, "ntasks": 512}, "ATM": {"rootpe": 512, "ntasks": 64, "nthrds": 1}}
+    >>> layout_key(a, "cost", "ndays", 5, "/case") == layout_key(b, "cost", "ndays", 5, "/case")
+    True
+    >>> layout_key(a, "cost", "ndays", 5, "/case") == layout_key(a, "throughput", "ndays", 5, "/case")
+    False
+    '''
+    layout = sorted((comp, vals["ntasks"], vals["nthrds"], vals["rootpe"]) for comp, vals in config.items())
+    return "layout:" + hashlib.sha256(repr((layout, metric, stop_option, stop_n, case_id)).encode()).hexdigest()
+
+def read_study_ctx(caseroots, bind_ranks=False):
+    # Values that are fixed for the lifetime of a study, read once per worker
+    with Case(caseroots[0], read_only=True) as case:
         comp_types = {comp: case.get_value(f"COMP_{comp}") for comp in COMPONENTS}
-    stub_comps = {comp for comp, val in comp_types.items() if val.lower().startswith("s")}
+        study_ctx = {"max_mpitasks_per_node": case.get_value("MAX_MPITASKS_PER_NODE"),
+                     "stub_comps": frozenset(comp for comp, val in comp_types.items() if val.lower().startswith("s")),
+                     "numa": numa_cores() if bind_ranks else None,
+                     # Walking the whole source tree is slow; do it once per worker, not per trial
+                     "srcroot_mtime": _newest_mtime(case.get_value("SRCROOT")),
+                     # Concurrent trials on a worker overlap only in config/build; runs
+                     # share the worker's nodes, so they must not contend for them
+                     "run_slots": threading.Semaphore(1)}
+    if study_ctx["numa"] and sum(map(len, study_ctx["numa"])) < study_ctx["max_mpitasks_per_node"]:
+        raise RuntimeError(f"Cannot bind {study_ctx['max_mpitasks_per_node']} ranks per node: "
+                           f"only {sum(map(len, study_ctx['numa']))} PUs found")
+    return study_ctx
 
-    raw_weights = {comp: trial.suggest_float(f"weight_{comp}", 0.01, 1.0)
-                   for comp in COMPONENTS if comp not in stub_comps}
-    weight_sum = sum(raw_weights.values())
+def objective(trial, study_ctx, stop_option, stop_n, metric):
+    max_mpitasks_per_node = study_ctx["max_mpitasks_per_node"]
+    stub_comps = study_ctx["stub_comps"]
 
-    task_counts = {}
-    for comp in COMPONENTS:
-        if comp in stub_comps:
-            task_counts[comp] = 1
-        else:
-            raw = raw_weights[comp] / weight_sum * TOTAL_PES
-            bounded = min(max(TASK_MIN_LIMITS.get(comp, 1), int(raw)), TASK_MAX_LIMITS.get(comp, TOTAL_PES))
-            snapped = snap_to_nearest(bounded, max_mpitasks_per_node)
-            task_counts[comp] = snapped
-            print(f"{comp} raw={int(raw)}, bounded={bounded}, snapped={snapped}")
-
-    overlap_map = {a: {b: trial.suggest_categorical(f"{a}_overlaps_{b}", [True, False])
-                       if a != b and b != "OCN" and a != "OCN" else False for b in COMPONENTS}
+    active = [comp for comp in COMPONENTS if comp not in stub_comps]
+    # n-1 free splits fully determine the shares, so the sampler never explores the
+    # scale direction that normalised weights leave invariant
+    shares = stick_breaking([trial.suggest_float(f"split_{comp}", 0.0, 1.0) for comp in active[:-1]])
+    mins = np.array([TASK_MIN_LIMITS.get(comp, 1) for comp in active])
+    # Split only the PEs left after every minimum is met, so unoverlapped layouts
+    # fit in TOTAL_PES up to snapping instead of mostly being rejected
+    raws = (mins + shares * (TOTAL_PES - mins.sum())).astype(int)
+    bounded = np.clip(raws, mins, [TASK_MAX_LIMITS.get(comp, TOTAL_PES) for comp in active])
+    snapped = snap_to_nearest(bounded, max_mpitasks_per_node)
+    task_counts = {comp: 1 for comp in stub_comps}
+    task_counts.update(zip(active, snapped.tolist()))
+    if log.isEnabledFor(logging.DEBUG):
+        for comp, raw, b, n in zip(active, raws, bounded, snapped):
+            log.debug("Trial %d: %s raw=%d, bounded=%d, snapped=%d", trial.number, comp, raw, b, n)
+
+    overlap_pairs = {(a, b): trial.suggest_categorical(f"{a}_overlaps_{b}", [True, False])
+                     for a, b in overlap_candidates(stub_comps)}
+    overlap_map = {a: {b: overlap_pairs.get((a, b), overlap_pairs.get((b, a), False)) for b in COMPONENTS}
                    for a in COMPONENTS}
 
     try:
-        rootpes = assign_rootpes(task_counts, overlap_map)
+        rootpes = assign_rootpes(task_counts, overlap_map, stub_comps)
     except Exception as e:
-        print(f"❌ Failed to assign rootpes: {e}")
+        log.warning("Trial %d: failed to assign rootpes: %s", trial.number, e)
         raise optuna.TrialPruned()
 
     config = {comp: {"ntasks": 1, "nthrds": 1, "rootpe": 0} if comp in stub_comps else {
               "ntasks": task_counts[comp], "nthrds": 1, "rootpe": rootpes[comp]} for comp in COMPONENTS}
 
-    with Case(caseroot, read_only=False) as case:
-        try:
-            configure_case(case, config, stop_option, stop_n)
-        except Exception as e:
-            print(f"⚠️ Model config/build failed: {e}")
+    # Different weights often snap to the same layout; reuse the result instead of rerunning the model
+    key = layout_key(config, metric, stop_option, stop_n, study_ctx["case_id"])
+    cached = trial.study.user_attrs.get(key)
+    if cached is not None:
+        trial.set_user_attr("duplicate_of", cached["trial"])
+        if cached.get("pruned"):
             raise optuna.TrialPruned()
+        return cached["value"]
+
+    # Take a free clone; with several jobs per worker the next trial builds in
+    # another clone while this one's model run is still going.
+    caseroot = study_ctx["caseroots"].get()
+    try:
+        return _evaluate(trial, study_ctx, caseroot, config, key, stop_option, stop_n, metric)
+    except optuna.TrialPruned:
+        # Only the pruner raises this from _evaluate; remember layouts it stopped so a
+        # resampled duplicate is not rebuilt and rerun. Failures may be transient, so
+        # they fail the trial without marking the layout.
+        trial.study.set_user_attr(key, {"trial": trial.number, "pruned": True})
+        raise
+    finally:
+        study_ctx["caseroots"].put(caseroot)
+
+def _evaluate(trial, study_ctx, caseroot, config, key, stop_option, stop_n, metric):
+    try:
+        rundir = study_ctx["executor"].submit(configure_case, caseroot, config, stop_option, stop_n,
+                                              study_ctx["srcroot_mtime"]).result()
+    except Exception as e:
+        raise RuntimeError(f"Model config/build failed: {e}") from e
+
+    total_pes = max(vals["rootpe"] + vals["ntasks"] * vals["nthrds"] for vals in config.values())
+    with study_ctx["run_slots"]:
+        rankfile = None
+        if study_ctx["numa"]:
+            rankfile = os.path.join(caseroot, "rankfile")
+            with open(rankfile, "w") as f:
+                f.write("\n".join(rankfile_lines(total_pes, study_ctx["max_mpitasks_per_node"], study_ctx["numa"])) + "\n")
+        run_case(trial, caseroot, rundir, total_pes, metric, rankfile)
         try:
             results = parse_timing(caseroot)
         except Exception as e:
-            print(f"⚠️ Timing error: {e}")
-            raise optuna.TrialPruned()
-    return results["throughput"] if metric == "throughput" else results["total_cost"]
+            raise RuntimeError(f"Timing error: {e}") from e
+    value = results["throughput"] if metric == "throughput" else results["total_cost"]
+    trial.study.set_user_attr(key, {"trial": trial.number, "value": value})
+    return value
+
+def clone_case(template, suffix):
+    caseroot = f"{os.path.abspath(template)}.{suffix}"
+    if not os.path.isdir(caseroot):
+        # The clone is a copy of this Case object and inherits its read_only flag
+        with Case(template, read_only=False) as case:
+            case.create_clone(caseroot, keepexe=False)
+    return caseroot
+
+def stop_days(stop_option, stop_n):
+    '''
+    Simulated days in a run, i.e. the number of progress steps run_case reports,
+    or None when STOP_OPTION is not a day-based unit.
+
+    >>> stop_days("ndays", 5), stop_days("nmonths", 1), stop_days("nyear", 2), stop_days("nsteps", 48)
+    (5, 30, 730, None)
+    '''
+    per_unit = {"nday": 1, "nmonth": 365 / 12, "nyear": 365}
+    days = per_unit.get(stop_option.rstrip("s"))
+    return None if days is None else max(1, int(days * stop_n))
+
+def create_study(args, worker_id=0):
+    max_resource = stop_days(args.stop_option, args.stop_n) or "auto"
+    pruner = optuna.pruners.HyperbandPruner(min_resource=1, max_resource=max_resource, reduction_factor=3)
+    # Offset the seed per worker so concurrent workers do not draw identical suggestions
+    seed = None if args.seed is None else args.seed + worker_id
+    # A trial costs a full model run, so spend sampler CPU on more EI candidates.
+    # As CMA-ES's independent sampler TPE only ever sees one parameter at a time,
+    # so modelling the parameters jointly is only worth asking for when TPE leads.
+    joint = {"multivariate": True, "group": True} if args.sampler == "tpe" else {}
+    tpe = optuna.samplers.TPESampler(n_ei_candidates=96, constant_liar=True, seed=seed, **joint)
+    if args.sampler == "cmaes":
+        # CMA-ES models the correlated split_* parameters; the boolean overlap
+        # parameters, which CMA-ES cannot handle, fall back to TPE. Counting pruned
+        # trials by their last reported value keeps Hyperband's early stops informative.
+        sampler = optuna.samplers.CmaEsSampler(n_startup_trials=8, seed=seed, warn_independent_sampling=False,
+                                               independent_sampler=tpe, consider_pruned_trials=True)
+    else:
+        sampler = tpe
+    study = optuna.create_study(study_name=args.study_name, storage=args.storage, load_if_exists=True,
+                                direction="maximize" if args.metric == "throughput" else "minimize",
+                                sampler=sampler, pruner=pruner)
+    # load_if_exists silently reuses a study with the same name, so refuse to
+    # resume one that was created for a different case or objective.
+    settings = {"metric": args.metric, "stop_option": args.stop_option, "stop_n": args.stop_n,
+                "caseroot": os.path.abspath(args.caseroot_template or args.caseroot)}
+    stored = {key: study.user_attrs.get(key) for key in settings}
+    if all(value is None for value in stored.values()):
+        for key, value in settings.items():
+            study.set_user_attr(key, value)
+    elif stored != settings:
+        raise RuntimeError(f"Study '{args.study_name}' in {args.storage} was created with {stored}, "
+                           f"not {settings}; pass a different --study-name")
+    return study
+
+def run_worker(args, worker_id, log_queue=None):
+    if log_queue is not None:
+        log_to_queue(log_queue, args.log_level)
+    if not args.caseroot_template:
+        caseroots = [args.caseroot]
+    elif args.jobs_per_worker == 1:
+        caseroots = [clone_case(args.caseroot_template, f"worker{worker_id}")]
+    else:
+        caseroots = [clone_case(args.caseroot_template, f"worker{worker_id}.job{j}")
+                     for j in range(args.jobs_per_worker)]
+    study_ctx = read_study_ctx(caseroots, args.bind_ranks)
+    study_ctx["case_id"] = os.path.abspath(args.caseroot_template or args.caseroot)
+    study_ctx["caseroots"] = queue.Queue()
+    for caseroot in caseroots:
+        study_ctx["caseroots"].put(caseroot)
+    study = create_study(args, worker_id)
+    # n_trials is per worker; the callback stops every worker once the study as a whole has enough trials
+    stop = optuna.study.MaxTrialsCallback(args.num_trials,
+                                          states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED))
+    # Setup and build run in spawned processes so concurrent trials never share CIME's
+    # process-wide state (working directory, logging); spawn avoids forking optuna's threads.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs_per_worker,
+                                                mp_context=multiprocessing.get_context("spawn")) as executor:
+        study_ctx["executor"] = executor
+        study.optimize(lambda trial: objective(trial, study_ctx, args.stop_option, args.stop_n, args.metric),
+                       n_trials=args.num_trials, n_jobs=args.jobs_per_worker, catch=(RuntimeError,), callbacks=[stop])
+
+def log_to_queue(log_queue, level):
+    # Called in every process that logs: workers started by spawn or forkserver
+    # do not inherit the parent's handlers
+    log.handlers = [logging.handlers.QueueHandler(log_queue)]
+    log.setLevel(level)
+    log.propagate = False
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+def setup_logging(level):
+    # Workers and their trial threads only enqueue records; a single listener
+    # thread in the main process does the terminal I/O. A multiprocessing queue
+    # can be handed to worker processes whatever their start method.
+    log_queue = multiprocessing.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(processName)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    log_to_queue(log_queue, level)
+    listener.start()
+    return listener
 
 def main():
     args = parse_args()
-    study = optuna.create_study(direction="maximize" if args.metric == "throughput" else "minimize")
-    study.optimize(lambda trial: objective(trial, args.caseroot, args.stop_option, args.stop_n, args.metric),
-                   n_trials=args.num_trials)
+    listener = setup_logging(args.log_level)
+    try:
+        study = create_study(args)
+        if args.worker_id is not None:
+            run_worker(args, args.worker_id)
+        elif args.num_workers == 1:
+            run_worker(args, 0)
+        else:
+            workers = [multiprocessing.Process(target=run_worker, args=(args, i, listener.queue))
+                       for i in range(args.num_workers)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+    finally:
+        # Flush queued worker records even when a worker or create_study raises
+        listener.stop()
     print("Best trial:")
     print(study.best_trial)
 